@@ -13,15 +13,80 @@ from qgis.processing import alg
 from qgis.core import (QgsProcessing,
                        QgsProcessingException,
                        QgsFeature,
+                       QgsFeatureSink,
+                       QgsFeatureRequest,
                        QgsGeometry,
                        QgsField,
                        QgsFields,
                        QgsWkbTypes,
-                       QgsPointXY,
-                       NULL)
+                       QgsPointXY)
 from qgis.PyQt.QtCore import (QVariant)
+from osgeo import gdal
+import numpy as np
 
 
+def field_index(fields, name, layer):
+    """
+    Return the index of the named field, raise an error naming the layer
+    if it has no such field.
+    """
+    i = fields.lookupField(name)
+    if i < 0:
+        raise QgsProcessingException(f"{layer} layer has no {name} field")
+    return i
+
+
+def sample_dem(ds, xy, tile=1024):
+    """
+    Sample the first band of a GDAL raster dataset at all the (N, 2)
+    coordinates in xy. Points are grouped by raster tiles and each tile
+    holding points is read with a single ReadAsArray call.
+    Nodata is compared in the band's own data type, then the band scale
+    and offset are applied.
+    Returns the sampled values and a mask of the points which could be
+    sampled (inside the raster and not nodata)
+    """
+    band = ds.GetRasterBand(1)
+    gt = ds.GetGeoTransform()
+    width, height = ds.RasterXSize, ds.RasterYSize
+    nodata = band.GetNoDataValue()
+
+    px = np.floor((xy[:, 0] - gt[0]) / gt[1]).astype(np.int64)
+    py = np.floor((xy[:, 1] - gt[3]) / gt[5]).astype(np.int64)
+    ok = (px >= 0) & (px < width) & (py >= 0) & (py < height)
+    values = np.zeros(len(xy))
+
+    # order points by tile, so every tile is read only once
+    idx = np.flatnonzero(ok)
+    tiles = (py[idx] // tile) * ((width + tile - 1) // tile) + px[idx] // tile
+    order = np.argsort(tiles, kind='stable')
+    idx = idx[order]
+    splits = np.flatnonzero(np.diff(tiles[order])) + 1
+    for group in np.split(idx, splits):
+        if not len(group):
+            continue
+        x0 = int(px[group[0]] // tile * tile)
+        y0 = int(py[group[0]] // tile * tile)
+        arr = band.ReadAsArray(x0, y0, min(tile, width - x0),
+                               min(tile, height - y0))
+        v = arr[py[group] - y0, px[group] - x0]
+        # a float nodata may not be exact once widened to float64
+        if nodata is not None:
+            if arr.dtype.kind == 'f':
+                ok[group] = v != np.array(nodata).astype(arr.dtype)
+            else:
+                ok[group] = v != nodata
+        values[group] = v
+
+    ok &= ~np.isnan(values)
+    scale = band.GetScale()
+    offset = band.GetOffset()
+    if scale is not None and scale != 1:
+        values *= scale
+    if offset:
+        values += offset
+    return values, ok
+
 @alg(name='calcprom', label="Calculate prominences of each DEM",
      group='sota', group_label="SOTA")
 @alg.input(type=alg.SOURCE, name='INPUT', label='Summit layer',
@@ -60,6 +125,21 @@ def calcprom(instance, parameters, context, feedback, inputs):
         raise QgsProcessingException(
             "At least one DEM layer must be specified")
 
+    # open the rasters once, before any output is created
+    datasets = {}
+    for d, layer in dems.items():
+        datasets[d] = gdal.Open(layer.source())
+        if datasets[d] is None:
+            raise QgsProcessingException(
+                f"Could not open {layer.name()} raster with GDAL")
+
+    # resolve the input field indexes once, the request filter would
+    # silently drop every feature if a field was missing
+    in_fields = source.fields()
+    idx_id = field_index(in_fields, 'ID', 'Summit')
+    idx_ele = field_index(in_fields, 'Elevation', 'Summit')
+    idx_col = field_index(in_fields, 'Col elevation', 'Summit')
+
     # output layer fields depend on available DEM layers
     fields = QgsFields()
     fields.append(QgsField("ID", QVariant.String))
@@ -75,27 +155,54 @@ def calcprom(instance, parameters, context, feedback, inputs):
         raise QgsProcessingException(
             instance.invalidSinkError(parameters, 'OUTPUT'))
 
-    for f in source.getFeatures():
-        # ignore summits that do not have elevation or col elevation specified
-        if f['Elevation'] == NULL or f['Col elevation'] == NULL:
-            continue
-
-        feature = QgsFeature(fields)
-        feature['ID'] = f['ID']
-        feature['Prominence'] = f['Elevation'] - f['Col elevation']
-
-        g = f.geometry()
-        pos = QgsPointXY(g.vertexAt(0))
-        col = QgsPointXY(g.vertexAt(1))
+    # collect the summits first, so each DEM can be sampled in one go
+    # ignore summits that do not have elevation or col elevation specified,
+    # the filter and the attribute subset are handled by the provider
+    request = QgsFeatureRequest()
+    request.setFilterExpression(
+        '"Elevation" IS NOT NULL AND "Col elevation" IS NOT NULL')
+    request.setSubsetOfAttributes([idx_id, idx_ele, idx_col])
+    summits = []
+    for f in source.getFeatures(request):
+        # first part of the geometry is the summit-col line
+        line = next(f.geometry().constParts())
+        attrs = f.attributes()
+        summits.append((attrs[idx_id], attrs[idx_ele] - attrs[idx_col],
+                        line.xAt(0), line.yAt(0), line.xAt(1), line.yAt(1)))
+
+    if not summits:
+        return {'OUTPUT': dest_id}
+
+    xy = np.array([s[2:] for s in summits], dtype=float)
+    dem_proms = []
+    for ds in datasets.values():
+        # summit and col positions are sampled together
+        values, ok = sample_dem(ds, xy.reshape(-1, 2))
+        values = values.reshape(-1, 2)
+        ok = ok.reshape(-1, 2).all(axis=1)
+        dem_proms.append(((values[:, 0] - values[:, 1]).tolist(), ok.tolist()))
+
+    # a single feature instance is filled for all the summits, copies of
+    # it are added to the sink in batches
+    buffer = []
+    feature = QgsFeature(fields)
+    attribs = [None] * fields.count()
+    for i, (sid, prom, px, py, cx, cy) in enumerate(summits):
+        attribs[0] = sid
+        attribs[1] = prom
+        for k, (dprom, ok) in enumerate(dem_proms, 2):
+            attribs[k] = dprom[i] if ok[i] else None
+        feature.setAttributes(attribs)
+
+        geometry = QgsGeometry.fromPolylineXY([QgsPointXY(px, py),
+                                               QgsPointXY(cx, cy)])
+        feature.setGeometry(geometry)
 
-        for d in dems:
-            dem = dems[d].dataProvider()
-            dp, dpok = dem.sample(pos, 1)
-            dc, dcok = dem.sample(col, 1)
-            if dpok and dcok:
-                feature[f"{d} Prominence"] = dp - dc
+        buffer.append(QgsFeature(feature))
+        if len(buffer) >= 2048:
+            sink.addFeatures(buffer, QgsFeatureSink.FastInsert)
+            buffer.clear()
 
-        geometry = QgsGeometry.fromPolylineXY([pos, col])
-        feature.setGeometry(geometry)
+    sink.addFeatures(buffer, QgsFeatureSink.FastInsert)
 
-        sink.addFeature(feature)
+    return {'OUTPUT': dest_id}
@@ -13,17 +13,135 @@ from qgis.processing import alg
 from qgis.core import (QgsProcessing,
                        QgsProcessingException,
                        QgsFeature,
+                       QgsFeatureRequest,
+                       QgsFeatureSink,
                        QgsGeometry,
                        QgsField,
                        QgsFields,
                        QgsWkbTypes,
-                       QgsPointXY,
                        NULL)
 from qgis.PyQt.QtCore import (QVariant)
+from osgeo import gdal
 
 #import matplotlib.pyplot as plt
-import re
+import numpy as np
+import struct
 
+DEM_NAMES = ('SRTM', 'ASTER', 'ALOS', 'TDX', 'GLO30')
+
+def field_index(fields, name, layer):
+    """
+    Return the index of the named field, raise an error naming the layer
+    if it has no such field.
+    """
+    i = fields.lookupField(name)
+    if i < 0:
+        raise QgsProcessingException(f"{layer} layer has no {name} field")
+    return i
+
+
+def dem_source(name):
+    """
+    Return the DEM key appearing first in the layer name (case
+    insensitive), or None if the name contains none of them.
+    """
+    name = name.upper()
+    found = [(name.find(d), d) for d in DEM_NAMES if d in name]
+    return min(found)[1] if found else None
+
+
+def int_columns(rows):
+    """
+    Return the pairs of attribute values as an (N, 2) int array, NULL
+    values replaced by 0, and the mask of the pairs with no NULL values.
+    """
+    valid = np.array([all(v != NULL for v in row) for row in rows],
+                     dtype=bool)
+    values = np.array([row if ok else (0, 0)
+                       for row, ok in zip(rows, valid.tolist())],
+                      dtype=np.int64).reshape(-1, 2)
+    return values, valid
+
+
+def cross_match(src, cand, pos_xy, det_xy, pos_err, col_err):
+    """
+    Return for each summit row the candidate row whose detected summit is
+    the closest to the summit, and the one whose detected col is the
+    closest to the col, only if strictly closer than the summit's own
+    detected position, otherwise -1. Candidates are given as (src, cand)
+    row pairs grouped by src, on equal distances the first listed
+    candidate wins. Distances use the same arithmetic as
+    QgsPointXY.distance.
+    """
+    result = []
+    for k, err in ((0, pos_err), (2, col_err)):
+        dx = det_xy[cand, k] - pos_xy[src, k]
+        dy = det_xy[cand, k + 1] - pos_xy[src, k + 1]
+        dist = np.sqrt(dx * dx + dy * dy)
+        keep = dist < err[src]
+        s, c, dist = src[keep], cand[keep], dist[keep]
+
+        # lexsort is stable, so ties keep the listed candidate order
+        order = np.lexsort((dist, s))
+        s, c = s[order], c[order]
+        first = np.ones(len(s), dtype=bool)
+        first[1:] = s[1:] != s[:-1]
+        match = np.full(len(pos_xy), -1, dtype=np.int64)
+        match[s[first]] = c[first]
+        result.append(match)
+    return result
+
+
+def sample_dem(ds, xy, tile=1024):
+    """
+    Sample the first band of a GDAL raster dataset at all the (N, 2)
+    coordinates in xy. Points are grouped by raster tiles and each tile
+    holding points is read with a single ReadAsArray call.
+    Nodata is compared in the band's own data type, then the band scale
+    and offset are applied.
+    Returns the sampled values and a mask of the points which could be
+    sampled (inside the raster and not nodata)
+    """
+    band = ds.GetRasterBand(1)
+    gt = ds.GetGeoTransform()
+    width, height = ds.RasterXSize, ds.RasterYSize
+    nodata = band.GetNoDataValue()
+
+    px = np.floor((xy[:, 0] - gt[0]) / gt[1]).astype(np.int64)
+    py = np.floor((xy[:, 1] - gt[3]) / gt[5]).astype(np.int64)
+    ok = (px >= 0) & (px < width) & (py >= 0) & (py < height)
+    values = np.zeros(len(xy))
+
+    # order points by tile, so every tile is read only once
+    idx = np.flatnonzero(ok)
+    tiles = (py[idx] // tile) * ((width + tile - 1) // tile) + px[idx] // tile
+    order = np.argsort(tiles, kind='stable')
+    idx = idx[order]
+    splits = np.flatnonzero(np.diff(tiles[order])) + 1
+    for group in np.split(idx, splits):
+        if not len(group):
+            continue
+        x0 = int(px[group[0]] // tile * tile)
+        y0 = int(py[group[0]] // tile * tile)
+        arr = band.ReadAsArray(x0, y0, min(tile, width - x0),
+                               min(tile, height - y0))
+        v = arr[py[group] - y0, px[group] - x0]
+        # a float nodata may not be exact once widened to float64
+        if nodata is not None:
+            if arr.dtype.kind == 'f':
+                ok[group] = v != np.array(nodata).astype(arr.dtype)
+            else:
+                ok[group] = v != nodata
+        values[group] = v
+
+    ok &= ~np.isnan(values)
+    scale = band.GetScale()
+    offset = band.GetOffset()
+    if scale is not None and scale != 1:
+        values *= scale
+    if offset:
+        values += offset
+    return values, ok
 
 @alg(name='demstat', label="Calculate relative stats of summits in a DEM",
      group='sota', group_label="SOTA")
@@ -42,12 +160,14 @@ def demstat(instance, parameters, context, feedback, inputs):
     layer = instance.parameterAsRasterLayer(parameters, 'DEM', context)
 
     # try to guess DEM source
-    m = re.search('SRTM|ASTER|ALOS|TDX|GLO30', layer.name(), re.I)
-    if not m:
+    dem_name = dem_source(layer.name())
+    if dem_name is None:
         raise QgsProcessingException(
             f"Could not infer DEM source from layer name {layer.name()}")
-    dem_name = m.group(0).upper()
-    dem = layer.dataProvider()
+    dem = gdal.Open(layer.source())
+    if dem is None:
+        raise QgsProcessingException(
+            f"Could not open {layer.name()} raster with GDAL")
 
     # output layer fields depend on available DEM layers
     fields = QgsFields()
@@ -79,107 +199,178 @@ def demstat(instance, parameters, context, feedback, inputs):
     # ele = []
     # err = []
 
-    # cycle through the features in two stes
-    # first get the position info for later cross-checking
-    summits = {}
-    for f in source.getFeatures():
-        gp = f.geometry().constParts()
-        
-        next(gp)
-        for d in ['SRTM', 'ASTER', 'ALOS', 'TDX', 'GLO30']:
-            if f[f'{d} Elevation'] != NULL:
-                g = next(gp)
-            if d == dem_name:
-                break
-        
-        v = g.vertices()
-        pos = QgsPointXY(next(v))
-        for c in v:
-            pass
-        
-        col = QgsPointXY(c)
-        summits[f['ID']] = [pos, col, f[f'{dem_name} Elevation'],
-                                      f[f'{dem_name} Col elevation']]
-
-    for f in source.getFeatures():
-        # ignore summits that do not have elevation or col elevation specified
-        if f['Elevation'] == NULL or f['Col elevation'] == NULL:
-            continue
+    # resolve the input field indexes once, DEM elevation fields are only
+    # needed up to the analysed DEM to count the preceding ridge parts
+    in_fields = source.fields()
+    idx_id = field_index(in_fields, 'ID', 'Summit')
+    idx_ele = field_index(in_fields, 'Elevation', 'Summit')
+    idx_col = field_index(in_fields, 'Col elevation', 'Summit')
+    idx_notes = field_index(in_fields, 'Notes', 'Summit')
+    idx_cross = field_index(in_fields, 'Cross', 'Summit')
+    idx_det_ele = in_fields.lookupField(f'{dem_name} Elevation')
+    idx_det_col = in_fields.lookupField(f'{dem_name} Col elevation')
+    if idx_det_ele < 0 or idx_det_col < 0:
+        raise QgsProcessingException(
+            f"Summit layer has no {dem_name} elevation fields")
+    idx_dems = []
+    for d in DEM_NAMES:
+        i = in_fields.lookupField(f'{d} Elevation')
+        if i >= 0:
+            idx_dems.append(i)
+        if d == dem_name:
+            break
 
-        # also ignore summits that are due to be further checked
-        if f['Notes'] == 'check':
-            continue
+    # go through the features once, storing the actual summit data and the
+    # position info detected in the DEM for later cross-checking
+    request = QgsFeatureRequest().setSubsetOfAttributes(
+        [idx_id, idx_ele, idx_col, idx_notes, idx_cross,
+         idx_det_ele, idx_det_col] + idx_dems)
+    ids = []
+    notes = []
+    cross = []
+    pos_xy = []
+    det_xy = []
+    ele = []
+    det_ele = []
+    for f in source.getFeatures(request):
+        # the first part is the summit-col line, followed by a ridge line
+        # for each DEM the summit was detected in
+        parts = f.geometry().constGet()
+        attrs = f.attributes()
+        index = 0
+        for i in idx_dems:
+            if attrs[i] != NULL:
+                index += 1
+
+        line = parts.geometryN(0)
+        ridge = parts.geometryN(index)
+        last = ridge.numPoints() - 1
+        ids.append(attrs[idx_id])
+        notes.append(attrs[idx_notes])
+        cross.append(attrs[idx_cross])
+        pos_xy.append((line.xAt(0), line.yAt(0), line.xAt(1), line.yAt(1)))
+        det_xy.append((ridge.xAt(0), ridge.yAt(0),
+                       ridge.xAt(last), ridge.yAt(last)))
+        ele.append((attrs[idx_ele], attrs[idx_col]))
+        det_ele.append((attrs[idx_det_ele], attrs[idx_det_col]))
+
+    # summit data as parallel arrays, one row per summit: summit and col
+    # coordinates, their elevations and the same detected in the DEM
+    id_to_row = {sid: i for i, sid in enumerate(ids)}
+    pos_xy = np.array(pos_xy, dtype=float).reshape(-1, 4)
+    det_xy = np.array(det_xy, dtype=float).reshape(-1, 4)
+    ele, has_ele = int_columns(ele)
+    det_ele, detected = int_columns(det_ele)
+    d = det_xy - pos_xy
+    pos_err = np.sqrt(d[:, 0] * d[:, 0] + d[:, 1] * d[:, 1])
+    col_err = np.sqrt(d[:, 2] * d[:, 2] + d[:, 3] * d[:, 3])
+
+    # ignore summits that do not have elevation or col elevation specified
+    # and also summits that are due to be further checked
+    checked = np.array([n != 'check' for n in notes], dtype=bool)
+    rows = np.flatnonzero(has_ele & checked)
 
-        # sample the DEM layer
-        g = f.geometry()
-        pos = QgsPointXY(g.vertexAt(0))
-        col = QgsPointXY(g.vertexAt(1))
-        dp, dpok = dem.sample(pos, 1)
-        dc, dcok = dem.sample(col, 1)
+    # sample the DEM layer at all summit and col positions at once
+    values, ok = sample_dem(dem, pos_xy[rows].reshape(-1, 2))
+    values = values.reshape(-1, 2)
+    ok = ok.reshape(-1, 2).all(axis=1).tolist()
 
+    # try to detect any crossmatches
+    # search the feature Cross property and if any position or col
+    # is closer than the actual position, take it as the preferred
+    # crosscorrect value
+    detected_l = detected.tolist()
+    src = []
+    cand = []
+    for r in rows.tolist():
+        if detected_l[r] and cross[r] != NULL:
+            for sid in cross[r].split():
+                i = id_to_row[sid]
+                if detected_l[i]:
+                    src.append(r)
+                    cand.append(i)
+    crossp, crossc = cross_match(np.array(src, dtype=np.int64),
+                                 np.array(cand, dtype=np.int64),
+                                 pos_xy, det_xy, pos_err, col_err)
+
+    # prominences of all summits, the crosscorrect elevations default to
+    # the summit's own detected ones
+    prom = ele[:, 0] - ele[:, 1]
+    dem_prom = values[:, 0] - values[:, 1]
+    det_prom = det_ele[:, 0] - det_ele[:, 1]
+    cc_prom = (np.where(crossp >= 0, det_ele[crossp, 0], det_ele[:, 0]) -
+               np.where(crossc >= 0, det_ele[crossc, 1], det_ele[:, 1]))
+
+    pos_l = pos_xy.tolist()
+    ele_l = ele.tolist()
+    det_ele_l = det_ele.tolist()
+    pos_err_l = pos_err.tolist()
+    col_err_l = col_err.tolist()
+    crossp = crossp.tolist()
+    crossc = crossc.tolist()
+    prom = prom.tolist()
+    det_prom = det_prom.tolist()
+    cc_prom = cc_prom.tolist()
+
+    # output features are copies of a template already set up with the
+    # output fields
+    template = QgsFeature(fields)
+    batch = []
+    for r, (dp, dc), dprom, dok in zip(rows.tolist(), values.tolist(),
+                                       dem_prom.tolist(), ok):
         # if sampling fails, also ignore the summit
-        if not dpok or not dcok:
+        if not dok:
             continue
 
-        feature = QgsFeature(fields)
-        feature['ID'] = f['ID']
-        feature['Elevation'] = f['Elevation']
-        feature['Col Elevation'] = f['Col Elevation']
-        feature['Prominence'] = f['Elevation'] - f['Col Elevation']
+        px, py, cx, cy = pos_l[r]
+        e, c = ele_l[r]
+        feature = QgsFeature(template)
+        feature['ID'] = ids[r]
+        feature['Elevation'] = e
+        feature['Col Elevation'] = c
+        feature['Prominence'] = prom[r]
 
         feature['DEM ele'] = dp
         feature['DEM col'] = dc
-        feature['DEM prom'] = dp - dc
-
-        if f[f'{dem_name} Elevation'] != NULL:
-            feature['Detected ele'] = f[f'{dem_name} Elevation']
-            feature['Detected col'] = f[f'{dem_name} Col elevation']
-            feature['Detected prom'] = feature['Detected ele'] - feature['Detected col']
-
-            feature['Pos error'] = pos.distance(summits[f['ID']][0])
-            feature['Col error'] = col.distance(summits[f['ID']][1])
-
-            # try to detect any crossmatches
-            # search the feature Cross property and if any position or col
-            # is closer than the actual position, take it as the preferred
-            # crosscorrect value
-            if f['Cross'] != NULL:
-                errp = feature['Pos error']
-                errc = feature['Col error']
-                crossp = None
-                crossc = None
-                for s in f['Cross'].split():
-                    p = pos.distance(summits[s][0])
-                    if p < errp:
-                        errp = p
-                        crossp = s
-                    c = col.distance(summits[s][1])
-                    if c < errc:
-                        errc = c
-                        crossc = s
-                
-                p = feature['Detected ele']
-                c = feature['Detected col']
-                if crossp or crossc:
-                    feature['Crossmatch'] = ' '.join(x for x in (crossp, crossc) if x)
-                if crossp:
-                    feature['Crosscorrect ele'] = summits[crossp][2]
-                    p = summits[crossp][2]
-                if crossc:
-                    feature['Crosscorrect col'] = summits[crossc][3]
-                    c = summits[crossc][3]
-                    
-                if crossp or crossc:
-                    feature['Crosscorrect prom'] = p - c
-                
-
-        geometry = QgsGeometry.fromPolylineXY([pos, col])
+        feature['DEM prom'] = dprom
+
+        if detected_l[r]:
+            p, c = det_ele_l[r]
+            feature['Detected ele'] = p
+            feature['Detected col'] = c
+            feature['Detected prom'] = det_prom[r]
+
+            feature['Pos error'] = pos_err_l[r]
+            feature['Col error'] = col_err_l[r]
+
+            cp = crossp[r]
+            cc = crossc[r]
+            if cp >= 0 or cc >= 0:
+                feature['Crossmatch'] = ' '.join(
+                    ids[x] for x in (cp, cc) if x >= 0)
+            if cp >= 0:
+                feature['Crosscorrect ele'] = det_ele_l[cp][0]
+            if cc >= 0:
+                feature['Crosscorrect col'] = det_ele_l[cc][1]
+
+            if cp >= 0 or cc >= 0:
+                feature['Crosscorrect prom'] = cc_prom[r]
+
+
+        # little endian WKB LineString (type 2) of the two points
+        geometry = QgsGeometry()
+        geometry.fromWkb(struct.pack('<BIIdddd', 1, 2, 2, px, py, cx, cy))
         feature.setGeometry(geometry)
 
-        sink.addFeature(feature)
+        batch.append(feature)
+        if len(batch) >= 10000:
+            sink.addFeatures(batch, QgsFeatureSink.FastInsert)
+            batch.clear()
 
         # ele.append(feature['Elevation'])
         # err.append(feature['Detected prom'] - feature['Prominence'])
 
+    sink.addFeatures(batch, QgsFeatureSink.FastInsert)
+
     # plt.scatter(ele, err)
     # plt.show()
\ No newline at end of file
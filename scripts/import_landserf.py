@@ -29,12 +29,45 @@ from qgis.core import (QgsField,
                        QgsPointXY,
                        QgsGeometry)
 from qgis import processing
-import re
+import numpy as np
+import struct
+
+def parse_lines(lines, count, kind):
+    """
+    Convert the count numeric values of each (lineno, line) entry, after
+    the leading line type character, into a 2D array in a single call.
+    Lines are checked one by one only to find the offending line if the
+    conversion fails.
+    """
+    try:
+        values = np.loadtxt([line[1:] for _, line in lines], ndmin=2)
+        if values.shape[1] != count:
+            raise ValueError
+    except ValueError:
+        for lineno, line in lines:
+            tokens = line[1:].split()
+            try:
+                if len(tokens) != count:
+                    raise ValueError
+                for token in tokens:
+                    float(token)
+            except ValueError:
+                raise QgsProcessingException(
+                    f"Wrong {kind} entry in Landserf vector file line {lineno}: '{line}'"
+                )
+        raise QgsProcessingException(
+            f"Wrong {kind} entries in Landserf vector file")
+    return values
+
+def polyline_wkb(coords):
+    """
+    Build the little endian WKB representation of a LineString from an
+    (N, 2) coordinate array: byte order flag, geometry type 2, number of
+    points, followed by the coordinate pairs
+    """
+    return (struct.pack('<BII', 1, 2, len(coords)) +
+            np.ascontiguousarray(coords, dtype='<f8').tobytes())
 
-# precompiled regex
-re_summit = re.compile(r'P ([+-]?(?:\d+\.|\.\d)\d*) ([+-]?(?:\d+\.|\.\d)\d*) ([+-]?(?:\d+\.|\.?\d)\d*)')
-re_ridge = re.compile(r'L (\d+) ([+-]?(?:\d+\.|\.\d)\d*)')
-re_coord = re.compile(r' ([+-]?(?:\d+\.|\.\d)\d*) ([+-]?(?:\d+\.|\.\d)\d*)')
 
 class ImportLandserf(QgsProcessingAlgorithm):
     """
@@ -56,6 +89,9 @@ class ImportLandserf(QgsProcessingAlgorithm):
     OUTLINE = 'OUTLINE'
     OUTPUT = 'OUTPUT'
 
+    # number of features added to the sink at once
+    BATCH = 2048
+
     def tr(self, string):
         """
         Returns a translatable string with the self.tr() function.
@@ -157,76 +193,97 @@ class ImportLandserf(QgsProcessingAlgorithm):
 
         # check Landserf file
         file = self.parameterAsFile(parameters, self.FILE, context)
-        summits = []
-        pos = None
-        col = None
-        ridge = None
-        elems = 0
-        lineno = 0
-        with open(file, "r") as f:
-            for line in f:
-                lineno += 1
-                line = line.rstrip()
-                if not line:
-                    continue
-                if pos is None:
-                    m = re_summit.fullmatch(line)
-                    if not m:
-                        raise QgsProcessingException(
-                            f"Wrong summit entry in Landserf vector file line {lineno}: '{line}'"
-                        )
-                    pos = (float(m.group(1)), float(m.group(2)), int(float(m.group(3))))
-                elif col is None:
-                    m = re_summit.fullmatch(line)
-                    if not m:
-                        raise QgsProcessingException(
-                            f"Wrong col entry in Landserf vector file line {lineno}: '{line}'"
-                        )
-                    col = (float(m.group(1)), float(m.group(2)), int(float(m.group(3))))
-                elif ridge is None:
-                    m = re_ridge.fullmatch(line)
-                    if not m:
-                        raise QgsProcessingException(
-                            f"Wrong ridge entry in Landserf vector file line {lineno}: '{line}'"
-                        )
-                    elems = int(m.group(1))
-                    ridge = []
-                elif elems > 0:
-                    m = re_coord.fullmatch(line)
-                    if not m:
-                        raise QgsProcessingException(
-                            f"Wrong coordinate entry in Landserf vector file line {lineno}: '{line}'"
-                        )
-                    ridge.insert(0, (float(m.group(1)), float(m.group(2))))
-                    elems -= 1
-                    if elems == 0:
-                        # at last ridge element make some more sanity checks
-                        if pos[0:2] != ridge[0] or col[0:2] != ridge[-1]:
-                            raise QgsProcessingException(
-                                f"Summit/col position doesn't match ridge start/end in Lanserf vector file line {lineno}"
-                            )
-                        if pos[2] != -col[2]:
-                            raise QgsProcessingException(
-                                f"Summit/col prominence value mismatch {pos[2]} <> {col[2]}"
-                            )
-                        # if values seem ok, add ridge to summit list
-                        # and reset values for next round
-                        summits.append({'prom': pos[2], 'ridge': ridge})
-                        pos = None
-                        col = None
-                        ridge = None
-                else:
-                    raise QgsProcessingException(
-                        f"Unrecognized/out of order line in Landserf vector file line {lineno}: {line}"
-                    )
-            # check if loop ends without storing last value
-            if col or pos or ridge:
+        # read the whole file and split it in one go instead of iterating
+        # and decoding it line by line
+        with open(file, "rb") as f:
+            data = f.read()
+        try:
+            data = data.decode('ascii')
+        except UnicodeDecodeError as e:
+            raise QgsProcessingException(
+                f"Invalid character in Landserf vector file {file}: {e}")
+        lines = [(lineno, line.rstrip())
+                 for lineno, line in enumerate(data.split('\n'), 1)]
+        lines = [x for x in lines if x[1]]
+
+        # walk the summit headers to check the structure of the file and
+        # split the lines by their kind, the numeric values are parsed later
+        # on in bulk
+        summit_lines = []
+        col_lines = []
+        coord_lines = []
+        lengths = []
+        i = 0
+        while i < len(lines):
+            if i + 3 > len(lines):
                 raise QgsProcessingException(
                     f"Unterminated summit data in Landserf vector file"
                 )
-        if not summits:
+            lineno, line = lines[i]
+            if not line.startswith('P'):
+                raise QgsProcessingException(
+                    f"Wrong summit entry in Landserf vector file line {lineno}: '{line}'"
+                )
+            lineno, line = lines[i + 1]
+            if not line.startswith('P'):
+                raise QgsProcessingException(
+                    f"Wrong col entry in Landserf vector file line {lineno}: '{line}'"
+                )
+            lineno, line = lines[i + 2]
+            parts = line.split()
+            try:
+                if (len(parts) != 3 or parts[0] != 'L' or
+                        not parts[1].isdigit() or int(parts[1]) == 0):
+                    raise ValueError
+                float(parts[2])
+            except ValueError:
+                raise QgsProcessingException(
+                    f"Wrong ridge entry in Landserf vector file line {lineno}: '{line}'"
+                )
+            elems = int(parts[1])
+            ridge = lines[i + 3:i + 3 + elems]
+            if len(ridge) < elems:
+                raise QgsProcessingException(
+                    f"Unterminated summit data in Landserf vector file"
+                )
+            for lineno, line in ridge:
+                if not line.startswith(' '):
+                    raise QgsProcessingException(
+                        f"Wrong coordinate entry in Landserf vector file line {lineno}: '{line}'"
+                    )
+            summit_lines.append(lines[i])
+            col_lines.append(lines[i + 1])
+            coord_lines.extend(ridge)
+            lengths.append(elems)
+            i += 3 + elems
+        if not lengths:
             raise QgsProcessingException(f"No summits read from {file}")
-        
+
+        pos = parse_lines(summit_lines, 3, 'summit')
+        col = parse_lines(col_lines, 3, 'col')
+        coords = parse_lines(coord_lines, 2, 'coordinate')
+
+        # ridges are stored from col to summit in the file
+        ends = np.cumsum(lengths) - 1
+        starts = ends - np.array(lengths) + 1
+        bad = np.flatnonzero((pos[:, 0:2] != coords[ends]).any(axis=1) |
+                             (col[:, 0:2] != coords[starts]).any(axis=1))
+        if len(bad):
+            lineno = coord_lines[ends[bad[0]]][0]
+            raise QgsProcessingException(
+                f"Summit/col position doesn't match ridge start/end in Lanserf vector file line {lineno}"
+            )
+        prom = pos[:, 2].astype(int)
+        cprom = col[:, 2].astype(int)
+        bad = np.flatnonzero(prom != -cprom)
+        if len(bad):
+            raise QgsProcessingException(
+                f"Summit/col prominence value mismatch {prom[bad[0]]} <> {cprom[bad[0]]}"
+            )
+        summits = [{'prom': p, 'ridge': r[::-1]}
+                   for p, r in zip(prom.tolist(),
+                                   np.split(coords, ends[:-1] + 1))]
+
         # Retrieve the source DEM
         dem_layer = self.parameterAsRasterLayer(parameters, self.DEM, context)
         if dem_layer is None:
@@ -246,6 +303,13 @@ class ImportLandserf(QgsProcessingAlgorithm):
                 raise QgsProcessingException( f"Couldn't create combined outline geometry: {gg.lastError()}")
             clipEngine = QgsGeometry.createGeometryEngine(gg.constGet())
             clipEngine.prepareGeometry()
+            # cheap bounding box test of all summits before asking GEOS
+            bbox = gg.boundingBox()
+            inBox = ((pos[:, 0] >= bbox.xMinimum()) &
+                     (pos[:, 0] <= bbox.xMaximum()) &
+                     (pos[:, 1] >= bbox.yMinimum()) &
+                     (pos[:, 1] <= bbox.yMaximum())).tolist()
+            clipPoint = QgsPoint()
         else:
             clipEngine = None
        
@@ -286,21 +350,33 @@ class ImportLandserf(QgsProcessingAlgorithm):
         # get features from source
         total = 100.0 / len(summits)
 
+        # a single feature and attribute list is reused for every summit,
+        # copies of it are buffered and added to the sink in batches
+        feature = QgsFeature()
+        attribs = [None] * fields.count()
+        buffer = []
         fid = 0
         for current, summit in enumerate(summits):
             # Stop the algorithm if cancel button has been clicked
             if feedback.isCanceled():
                 break
 
-            # get ridgeline
-            poly = [QgsPointXY(x[0], x[1]) for x in summit['ridge']]
+            # get ridgeline ends
+            ridge = summit['ridge']
+            start = QgsPointXY(*ridge[0])
+            end = QgsPointXY(*ridge[-1])
 
             # check against clipping outline
-            if clipEngine and not clipEngine.contains(QgsPoint(poly[0])):
-                continue
+            if clipEngine:
+                if not inBox[current]:
+                    continue
+                clipPoint.setX(start.x())
+                clipPoint.setY(start.y())
+                if not clipEngine.contains(clipPoint):
+                    continue
 
-            ele, sok = dem.sample(poly[0], 1)
-            cele, cok = dem.sample(poly[-1], 1)
+            ele, sok = dem.sample(start, 1)
+            cele, cok = dem.sample(end, 1)
             
             # if failed to sample or sampled value is the minimum value of
             # the raster layer then ignore the summit
@@ -309,18 +385,29 @@ class ImportLandserf(QgsProcessingAlgorithm):
             if cele == demstats.minimumValue:
                 continue
                 
-            feature = QgsFeature()
-            feature.setGeometry(QgsGeometry.fromPolylineXY(poly))
-            attribs = [fid, str(summit['prom']), ele, cele, None]
+            geometry = QgsGeometry()
+            geometry.fromWkb(polyline_wkb(ridge))
+            feature.setGeometry(geometry)
+            attribs[0] = fid
+            attribs[1] = str(summit['prom'])
+            attribs[2] = ele
+            attribs[3] = cele
             feature.setAttributes(attribs)
             
             # Add a feature in the sink
-            sink.addFeature(feature, QgsFeatureSink.FastInsert)
+            buffer.append(QgsFeature(feature))
             fid += 1
 
+            if len(buffer) >= self.BATCH:
+                sink.addFeatures(buffer, QgsFeatureSink.FastInsert)
+                buffer.clear()
+
             # Update the progress bar
             feedback.setProgress(int(current * total))
 
+        if buffer:
+            sink.addFeatures(buffer, QgsFeatureSink.FastInsert)
+
         # Return the results of the algorithm. In this case our only result is
         # the feature sink which contains the processed features, but some
         # algorithms may return multiple feature sinks, calculated numeric
@@ -15,10 +15,10 @@ from qgis.core import (QgsProcessing,
                        QgsGeometry,
                        QgsPointXY,
                        QgsFeature,
+                       QgsFeatureRequest,
                        QgsField,
                        QgsFields,
                        QgsWkbTypes,
-                       QgsSpatialIndex,
                        QgsFeatureSink,
                        QgsProcessingException,
                        QgsProcessingAlgorithm,
@@ -26,10 +26,42 @@ from qgis.core import (QgsProcessing,
                        QgsProcessingParameterCrs,
                        QgsProcessingParameterDistance,
                        QgsProcessingParameterFeatureSink)
-import re
+import numpy as np
 import sys
 
 
+def neighbours(xy, k, distance, block=256):
+    """
+    Return for each point of the (N, 2) xy array the indices of its k
+    nearest points (including itself) within distance, ordered by
+    distance. Like QgsSpatialIndex.nearestNeighbor, points tied with the
+    k-th nearest one are also returned.
+    Points are sorted by x once, then distances for each block of rows are
+    evaluated with NumPy only against the points inside the block's
+    x range widened by distance.
+    """
+    limit = distance * distance
+    order = np.argsort(xy[:, 0], kind='stable')
+    sxy = xy[order]
+    x = sxy[:, 0]
+    result = [None] * len(xy)
+    for start in range(0, len(xy), block):
+        rows = sxy[start:start + block]
+        lo = np.searchsorted(x, rows[0, 0] - distance, 'left')
+        hi = np.searchsorted(x, rows[-1, 0] + distance, 'right')
+        d2 = ((rows[:, None, :] - sxy[None, lo:hi, :]) ** 2).sum(axis=2)
+        for i, row in zip(order[start:start + block].tolist(), d2):
+            near = np.flatnonzero(row <= limit)
+            dist = row[near]
+            near = order[lo + near]
+            s = np.lexsort((near, dist))
+            near, dist = near[s], dist[s]
+            if len(near) > k:
+                near = near[dist <= dist[k - 1]]
+            result[i] = near.tolist()
+    return result
+
+
 class MergeSummitLayers(QgsProcessingAlgorithm):
     """
     This is a helper Processing algorithm, to merge the existing
@@ -204,14 +236,17 @@ class MergeSummitLayers(QgsProcessingAlgorithm):
                     self.tr(f"Using destination CRS {outputCrs.authid()}"))
 
             totalFeatureCount += layer.featureCount()
-            m = re.search('|'.join(layerList.keys()), layer.name(), re.I)
-            if not m:
+            # the DEM key appearing first in the layer name
+            name = layer.name().upper()
+            found = [(name.find(d), d) for d in layerList if d in name]
+            if not found:
                 raise QgsProcessingException(
                     f"Layer name {layer.name()} does not infer a known DEM type")
-            if layerList[m.group(0).upper()]:
+            dem = min(found)[1]
+            if layerList[dem]:
                 raise QgsProcessingException(
-                    f"Layer {layer.name()} appears to be the same DEM as {layerList[m.group(0)].name()}")
-            layerList[m.group(0).upper()] = layer
+                    f"Layer {layer.name()} appears to be the same DEM as {layerList[dem].name()}")
+            layerList[dem] = layer
 
         for dem in layerList:
             if layerList[dem]:
@@ -239,10 +274,15 @@ class MergeSummitLayers(QgsProcessingAlgorithm):
         total = 100.0 / totalFeatureCount if totalFeatureCount else 0
         current = 0
 
-        summits = []
+        # summit data is collected column-wise: DEM name, ridge geometry,
+        # elevations and summit/col coordinates in parallel lists
+        dems = []
+        geoms = []
+        elevs = []
+        celevs = []
+        sxy = []
+        cxy = []
         current = 0
-        sisummit = QgsSpatialIndex()
-        sicol = QgsSpatialIndex()
 
         for dem, layer in layerList.items():
             # stop algorithm if cancel button was pressed
@@ -253,84 +293,122 @@ class MergeSummitLayers(QgsProcessingAlgorithm):
                 continue
                 
             feedback.pushInfo(f"DEM {dem}")
-            for f in layer.getFeatures():
+            request = QgsFeatureRequest().setSubsetOfAttributes(
+                ['Elevation', 'Col elevation'], layer.fields())
+            for f in layer.getFeatures(request):
                 if not f.hasGeometry():
                     continue
 
+                # summit and col are the ends of the ridge line
                 g = f.geometry()
-                gs = QgsGeometry(g.vertexAt(0))
-                fp = QgsFeature()
-                fp.setGeometry(gs)
-                fp.setId(current)
-                sisummit.addFeature(fp)
-                gc = QgsGeometry(g.vertexAt(g.constGet().nCoordinates() - 1))
-                fp = QgsFeature()
-                fp.setGeometry(gc)
-                fp.setId(current)
-                sicol.addFeature(fp)
-                summits.append(
-                    (dem, f['Elevation'], f['Col elevation'], g, gs, gc))
+                line = next(g.constParts())
+                last = line.numPoints() - 1
+                dems.append(dem)
+                geoms.append(g)
+                elevs.append(f['Elevation'])
+                celevs.append(f['Col elevation'])
+                sxy.append((line.xAt(0), line.yAt(0)))
+                cxy.append((line.xAt(last), line.yAt(last)))
                 current += 1
 
-        # make neighborhood list in the spatial indexes
+        # make neighborhood list of the summit and col positions
+        count = len(dems)
+        sxy = np.array(sxy, dtype=float).reshape(-1, 2)
+        cxy = np.array(cxy, dtype=float).reshape(-1, 2)
+        elev = np.array(elevs, dtype=np.int64)
+        celev = np.array(celevs, dtype=np.int64)
+        snear = neighbours(sxy, 5, distance)
+        cnear = neighbours(cxy, 20, distance)
+        # summits matching on both summit and col position are grouped
+        # together with a disjoint-set (union-find) structure
+        parent = list(range(count))
+        height = [0] * count
+
+        def find(x):
+            root = x
+            while parent[root] != root:
+                root = parent[root]
+            while parent[x] != root:
+                parent[x], x = root, parent[x]
+            return root
+
+        def union(x, y):
+            x = find(x)
+            y = find(y)
+            if x == y:
+                return
+            if height[x] < height[y]:
+                x, y = y, x
+            parent[y] = x
+            if height[x] == height[y]:
+                height[x] += 1
+
         smatch = []
         cmatch = []
-        dmatch = {}
-        for i in range(len(summits)):
-            s = sisummit.nearestNeighbor(summits[i][4], 5, distance)
-            c = sicol.nearestNeighbor(summits[i][5], 20, distance)
-            m = set(x for x in s if x in c)
+        for i in range(count):
+            s = snear[i]
+            c = cnear[i]
             smatch.append([x for x in s if x not in c])
             cmatch.append([x for x in c if x not in s])
-            m |= set(item for x in m if x in dmatch for item in dmatch[x])
-            for x in m:
-                dmatch[x] = tuple(sorted(m))
-        dm = set(dmatch.values())
+            for x in s:
+                if x in c:
+                    union(i, x)
 
-        def meanXY(points):
-            return QgsPointXY(sum(p.asPoint().x() for p in points) / len(points),
-                              sum(p.asPoint().y() for p in points) / len(points))
+        # groups keep the summits in ascending order, so the geometry parts
+        # will follow the DEM order
+        groups = {}
+        for i in range(count):
+            groups.setdefault(find(i), []).append(i)
+        dm = list(groups.values())
 
         features = []
         fmap = {}
+        # summit indices to merge/cross with for each feature, they are
+        # converted to IDs once the final order is known
+        merge_ids = []
+        cross_ids = []
         for m in dm:
-            gm = QgsGeometry.fromPolylineXY([meanXY([summits[i][4] for i in m]),
-                                             meanXY([summits[i][5] for i in m])])
+            # mean summit and col positions of the group
+            idx = list(m)
+            gm = QgsGeometry.fromPolylineXY([QgsPointXY(*sxy[idx].mean(axis=0)),
+                                             QgsPointXY(*cxy[idx].mean(axis=0))])
             f = QgsFeature(fields)
             f.setGeometry(QgsGeometry.collectGeometry(
-                [gm] + [summits[i][3] for i in m]))
-            e = 0
-            c = 0
-            ss = []
-            cc = []
-            for i in m:
-                f[f'{summits[i][0]} Elevation'] = summits[i][1]
-                f[f'{summits[i][0]} Col elevation'] = summits[i][2]
-                e += summits[i][1]
-                c += summits[i][2]
+                [gm] + [geoms[i] for i in idx]))
+            ss = set()
+            cc = set()
+            for i in idx:
+                f[f'{dems[i]} Elevation'] = elevs[i]
+                f[f'{dems[i]} Col elevation'] = celevs[i]
                 fmap[i] = len(features)
-                ss.extend(smatch[i])
-                cc.extend(cmatch[i])
-            f['Prominence'] = (e - c) / len(m)
-            if ss:
-                f['Merge'] = ','.join(f'{x}' for x in ss)
-            if cc:
-                f['Cross'] = ','.join(f'{x}' for x in cc)
+                ss.update(smatch[i])
+                cc.update(cmatch[i])
+            f['Prominence'] = int(elev[idx].sum() - celev[idx].sum()) / len(idx)
+            merge_ids.append(ss)
+            cross_ids.append(cc)
 
             features.append(f)
 
-        index, features = zip(*sorted(enumerate(features), key=lambda s: s[1]['Prominence'], reverse=True))
-        index = [x[0] for x in sorted(enumerate(index), key=lambda s: s[1])]
-        #index = sorted(range(len(features)), key=lambda s: features[s]['Prominence'], reverse=True)
-        for i, f in enumerate(features):
+        # order by descending prominence, rank is the inverse permutation
+        # giving the new position of each feature
+        prom = np.fromiter((f['Prominence'] for f in features), dtype=float,
+                           count=len(features))
+        order = np.argsort(-prom, kind='stable')
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        rank = rank.tolist()
+        order = order.tolist()
+        features = [features[j] for j in order]
+        for i, j in enumerate(order):
+            f = features[i]
             f['fid'] = i
             f['ID'] = f'S{i+1:04}'
-            if f['Merge']:
-                m = set(fmap[int(x)] for x in f['Merge'].split(','))
-                f['Merge'] = ' '.join(f'S{index[x]+1:04}' for x in m)
-            if f['Cross']:
-                m = set(fmap[int(x)] for x in f['Cross'].split(','))
-                f['Cross'] = ' '.join(f'S{index[x]+1:04}' for x in m)
+            if merge_ids[j]:
+                m = set(fmap[x] for x in merge_ids[j])
+                f['Merge'] = ' '.join(f'S{rank[x]+1:04}' for x in m)
+            if cross_ids[j]:
+                m = set(fmap[x] for x in cross_ids[j])
+                f['Cross'] = ' '.join(f'S{rank[x]+1:04}' for x in m)
 
         sink.addFeatures(features, QgsFeatureSink.FastInsert)
 
@@ -12,12 +12,40 @@ __license__ = "MIT"
 from qgis.processing import alg
 from qgis.core import (QgsProcessing,
                        QgsProcessingException,
-                       QgsFeature,
                        QgsFeatureSink,
-                       QgsGeometry,
                        QgsField,
-                       QgsSpatialIndex)
+                       NULL)
 from qgis.PyQt.QtCore import (QVariant)
+import numpy as np
+
+
+def field_index(fields, name, layer):
+    """
+    Return the index of the named field, raise an error naming the layer
+    if it has no such field.
+    """
+    i = fields.lookupField(name)
+    if i < 0:
+        raise QgsProcessingException(f"{layer} layer has no {name} field")
+    return i
+
+
+def nearest(ref, xy, distance, block=256):
+    """
+    Return for each point of the (N, 2) xy array the index of the nearest
+    point of the (M, 2) ref array within distance, or -1 if there is none.
+    Distances are computed with NumPy for blocks of points at once.
+    """
+    result = np.full(len(xy), -1, dtype=np.int64)
+    if not len(ref):
+        return result
+    limit = distance * distance
+    for start in range(0, len(xy), block):
+        d2 = ((xy[start:start + block, None, :] - ref[None, :, :]) ** 2).sum(axis=2)
+        k = d2.argmin(axis=1)
+        found = d2[np.arange(len(k)), k] <= limit
+        result[start:start + len(k)][found] = k[found]
+    return result
 
 
 @alg(name='topomatch', label="Match topo25 layer with merged summit layer",
@@ -56,90 +84,137 @@ def topo25match(instance, parameters, context, feedback, inputs):
         parameters, 'OUTPUT', context,
         fields, reference.wkbType(), reference.sourceCrs())
 
-    # create spatial index of the reference summit and col positions
-    summits = QgsSpatialIndex()
-    cols = QgsSpatialIndex()
-    index = 0
+    # resolve the field indexes once
+    src_fields = source.fields()
+    idx_id = field_index(src_fields, 'ID', 'Summit')
+    idx_name = field_index(src_fields, 'Name', 'Summit')
+    idx_ele = field_index(src_fields, 'Elevation', 'Summit')
+    idx_col = field_index(src_fields, 'Col elevation', 'Summit')
+    idx_ref = field_index(src_fields, 'Reference', 'Summit')
+    idx_prom = field_index(src_fields, 'Prominence', 'Summit')
+    idx_notes = field_index(src_fields, 'Notes', 'Summit')
+    ref_fields = reference.fields()
+    ridx_action = field_index(ref_fields, 'action', 'Reference')
+    ridx_ref = field_index(ref_fields, 'ref', 'Reference')
+    ridx_name = field_index(ref_fields, 'name', 'Reference')
+    ridx_ele = field_index(ref_fields, 'check ele', 'Reference')
+    ridx_col = field_index(ref_fields, 'check col', 'Reference')
+
+    # collect the reference summit and col positions
+    summit_xy = []
+    col_xy = []
     ref_list = []
+    ref_attrs = []
     for f in reference.getFeatures():
         if not f.hasGeometry():
             continue
 
         # ignore summits marked for delete
-        if f['action'] == 'delete':
+        attrs = f.attributes()
+        if attrs[ridx_action] == 'delete':
             continue
 
         g = f.geometry()
-        gs = QgsGeometry(g.vertexAt(0))
-        fp = QgsFeature()
-        fp.setGeometry(gs)
-        fp.setId(index)
-        summits.addFeature(fp)
-        gc = QgsGeometry(g.vertexAt(g.constGet().nCoordinates() - 1))
-        fp = QgsFeature()
-        fp.setGeometry(gc)
-        fp.setId(index)
-        cols.addFeature(fp)
+        gs = g.vertexAt(0)
+        gc = g.vertexAt(g.constGet().nCoordinates() - 1)
+        summit_xy.append((gs.x(), gs.y()))
+        col_xy.append((gc.x(), gc.y()))
         ref_list.append(f)
-        index += 1
-
+        ref_attrs.append(attrs)
+
+    # find the nearest reference summit and col of all source features in
+    # one go
+    features = list(source.getFeatures())
+    pos_xy = []
+    pos_col_xy = []
+    for f in features:
+        g = f.geometry()
+        gs = g.vertexAt(0)
+        gc = g.vertexAt(1)
+        pos_xy.append((gs.x(), gs.y()))
+        pos_col_xy.append((gc.x(), gc.y()))
+    near_summit = nearest(np.array(summit_xy, dtype=float).reshape(-1, 2),
+                          np.array(pos_xy, dtype=float).reshape(-1, 2),
+                          0.005).tolist()
+    near_col = nearest(np.array(col_xy, dtype=float).reshape(-1, 2),
+                       np.array(pos_col_xy, dtype=float).reshape(-1, 2),
+                       0.01).tolist()
+
+    batch = []
     matched = set()
     candidate = {}
     # and now go through the source layer and update the fields
-    for f in source.getFeatures():
+    for f, i, j in zip(features, near_summit, near_col):
         if feedback.isCanceled():
             break
 
         g = f.geometry()
-        # try to find nearest reference summit
-        i = summits.nearestNeighbor(QgsGeometry(g.vertexAt(0)), 1, 0.005)
-        if i:
-            i = i[0]
-            j = cols.nearestNeighbor(QgsGeometry(g.vertexAt(1)), 1, 0.01)
-            if i in j:
+        attrs = f.attributes()
+        # check the nearest reference summit
+        if i >= 0:
+            if i == j:
                 # found the match
                 rf = ref_list[i]
+                rattrs = ref_attrs[i]
+                action = rattrs[ridx_action]
                 # switchable summits will not be refed over
-                if 'switch' in rf['action']:
+                if 'switch' in action:
                     notes = []
                 else:
                     matched.add(i)
-                    f['Reference'] = rf['ref']
-                    notes = [] if rf['action'] == 'ok' else [rf['action']]
-                if not f['Name']:
-                    f['Name'] = rf['name']
-                if not f['Elevation']:
-                    if rf['check ele']:
-                        if rf['check ele'].isdecimal():
-                            f['Elevation'] = int(rf['check ele'])
+                    attrs[idx_ref] = rattrs[ridx_ref]
+                    notes = [] if action == 'ok' else [action]
+                if not attrs[idx_name]:
+                    attrs[idx_name] = rattrs[ridx_name]
+                if not attrs[idx_ele]:
+                    check = rattrs[ridx_ele]
+                    if check:
+                        if check.isdecimal():
+                            attrs[idx_ele] = int(check)
                             g.moveVertex(rf.geometry().vertexAt(0), 0)
                             f.setGeometry(g)
                         else:
-                            notes.append(f"ele:{rf['check ele']}")
-                if not f['Col elevation']:
-                    if rf['check col']:
-                        if rf['check col'].isdecimal():
-                            f['Col elevation'] = int(rf['check col'])
+                            notes.append(f"ele:{check}")
+                if not attrs[idx_col]:
+                    check = rattrs[ridx_col]
+                    if check:
+                        if check.isdecimal():
+                            attrs[idx_col] = int(check)
                             g.moveVertex(rf.geometry().vertexAt(1), 1)
                             f.setGeometry(g)
                         else:
-                            notes.append(f"col:{rf['check col']}")
+                            notes.append(f"col:{check}")
             else:
-                candidate[i] = f['ID']
+                candidate[i] = attrs[idx_id]
                 
-            if f['Elevation'] and f['Col elevation']:
-                f['Prominence'] = f['Elevation'] - f['Col elevation']
+            ele = attrs[idx_ele]
+            col = attrs[idx_col]
+            if ele and col:
+                attrs[idx_prom] = ele - col
             if notes:
-                f['Notes'] = '; '.join(notes)
+                attrs[idx_notes] = '; '.join(notes)
+            f.setAttributes(attrs)
+
+        batch.append(f)
+        if len(batch) >= 10000:
+            sink.addFeatures(batch, QgsFeatureSink.FastInsert)
+            batch.clear()
 
-        sink.addFeature(f, QgsFeatureSink.FastInsert)
+    sink.addFeatures(batch, QgsFeatureSink.FastInsert)
 
-    # finally build the remaining list
+    # finally build the remaining list, extending the attributes with the
+    # Match field
+    batch = []
     for i, f in enumerate(ref_list):
-        f.padAttributes(1)
-        if i not in matched:
-            if i in candidate:
-                f.setAttribute(f.attributeCount() - 1, candidate[i])
-            remainder.addFeature(f, QgsFeatureSink.FastInsert)
+        if i in matched:
+            continue
+        f.setAttributes(ref_attrs[i] + [candidate.get(i, NULL)])
+
+        batch.append(f)
+        if len(batch) >= 10000:
+            remainder.addFeatures(batch, QgsFeatureSink.FastInsert)
+            batch.clear()
+
+    remainder.addFeatures(batch, QgsFeatureSink.FastInsert)
 
     return {'OUTPUT': dest_id, 'REM': rem_id}
@@ -15,10 +15,24 @@ from qgis.core import (QgsProcessing,
                        QgsProcessingException,
                        QgsFeature,
                        QgsFeatureSink,
+                       QgsFeatureRequest,
                        QgsGeometry,
                        QgsField,
-                       QgsSpatialIndex)
+                       QgsSpatialIndex,
+                       NULL)
 from qgis.PyQt.QtCore import (QVariant)
+import numpy as np
+
+
+def field_index(fields, name, layer):
+    """
+    Return the index of the named field, raise an error naming the layer
+    if it has no such field.
+    """
+    i = fields.lookupField(name)
+    if i < 0:
+        raise QgsProcessingException(f"{layer} layer has no {name} field")
+    return i
 
 
 @alg(name='topomatchm', label="Match remainder topo25 layer with merged summit layer",
@@ -49,58 +63,100 @@ def topo25match(instance, parameters, context, feedback, inputs):
         parameters, 'OUTPUT', context,
         source.fields(), source.wkbType(), source.sourceCrs())
 
+    # resolve the field indexes once
+    src_fields = source.fields()
+    idx_fid = field_index(src_fields, 'fid', 'Summit')
+    idx_id = field_index(src_fields, 'ID', 'Summit')
+    idx_name = field_index(src_fields, 'Name', 'Summit')
+    idx_ele = field_index(src_fields, 'Elevation', 'Summit')
+    idx_col = field_index(src_fields, 'Col elevation', 'Summit')
+    idx_ref = field_index(src_fields, 'Reference', 'Summit')
+    idx_prom = field_index(src_fields, 'Prominence', 'Summit')
+    idx_notes = field_index(src_fields, 'Notes', 'Summit')
+    ref_fields = reference.fields()
+    ridx_match = field_index(ref_fields, 'Match', 'Reference')
+    ridx_action = field_index(ref_fields, 'action', 'Reference')
+    ridx_ref = field_index(ref_fields, 'ref', 'Reference')
+    ridx_name = field_index(ref_fields, 'name', 'Reference')
+    ridx_ele = field_index(ref_fields, 'check ele', 'Reference')
+    ridx_col = field_index(ref_fields, 'check col', 'Reference')
+
     # create dict with the reference data for easier finding
-    refs = dict((r['Match'], r) for r in reference.getFeatures() if r['Match'])
+    request = QgsFeatureRequest().setSubsetOfAttributes(
+        [ridx_match, ridx_action, ridx_ref, ridx_name, ridx_ele, ridx_col])
+    refs = {}
+    for r in reference.getFeatures(request):
+        rattrs = r.attributes()
+        if rattrs[ridx_match]:
+            refs[rattrs[ridx_match]] = (r, rattrs)
 
     features = []
+    refkey = []
+    prom = []
     # and now go through the source layer and update the fields
     for f in source.getFeatures():
         if feedback.isCanceled():
             break
 
-        if f['ID'] in refs:
-            rf = refs[f['ID']]
+        attrs = f.attributes()
+        sid = attrs[idx_id]
+        if sid in refs:
+            rf, rattrs = refs[sid]
             g = f.geometry()
+            action = rattrs[ridx_action]
 
             # if summit is marked as move, do not copy over the referen ce
-            if 'move' in rf['action']:
+            if 'move' in action:
                 notes = []
             else:
-                f['Reference'] = rf['ref']
-                notes = [] if rf['action'] in ('ok', 'move') else [rf['action']]
-            if not f['Name']:
-                f['Name'] = rf['name']
-            if not f['Elevation']:
-                if rf['check ele']:
-                    if rf['check ele'].isdecimal():
-                        f['Elevation'] = int(rf['check ele'])
+                attrs[idx_ref] = rattrs[ridx_ref]
+                notes = [] if action in ('ok', 'move') else [action]
+            if not attrs[idx_name]:
+                attrs[idx_name] = rattrs[ridx_name]
+            if not attrs[idx_ele]:
+                check = rattrs[ridx_ele]
+                if check:
+                    if check.isdecimal():
+                        attrs[idx_ele] = int(check)
                     else:
-                        notes.append(f"ele:{rf['check ele']}")
+                        notes.append(f"ele:{check}")
                     g.moveVertex(rf.geometry().vertexAt(0), 0)
                     f.setGeometry(g)
 
-            if not f['Col elevation']:
-                if rf['check col']:
-                    if rf['check col'].isdecimal():
-                        f['Col elevation'] = int(rf['check col'])
+            if not attrs[idx_col]:
+                check = rattrs[ridx_col]
+                if check:
+                    if check.isdecimal():
+                        attrs[idx_col] = int(check)
                     else:
-                        notes.append(f"col:{rf['check col']}")
+                        notes.append(f"col:{check}")
                     g.moveVertex(rf.geometry().vertexAt(1), 1)
                     f.setGeometry(g)
 
             if notes:
-                f['Notes'] = '; '.join(notes)
+                attrs[idx_notes] = '; '.join(notes)
 
-        if f['Elevation'] and f['Col elevation']:
-            f['Prominence'] = f['Elevation'] - f['Col elevation']
-    
-        features.append(f)
+        ele = attrs[idx_ele]
+        col = attrs[idx_col]
+        if ele and col:
+            attrs[idx_prom] = ele - col
+        f.setAttributes(attrs)
 
-    features.sort(key=lambda f: (0, f['Reference']) if f['Reference'] else
-                                (1, -f['Prominence']))
+        features.append(f)
+        refkey.append(attrs[idx_ref] or '')
+        prom.append(attrs[idx_prom] if attrs[idx_prom] != NULL else np.nan)
+
+    # referenced summits come first ordered by reference code, then the
+    # rest by descending prominence
+    refkey = np.array(refkey, dtype=str)
+    prom = np.array(prom, dtype=float)
+    bucket = (refkey == '').astype(np.int8)
+    promkey = np.where(bucket == 1, -prom, 0)
+    order = np.lexsort((promkey, refkey, bucket))
+    features = [features[i] for i in order]
 
     for i, f in enumerate(features):
-        f['fid'] = i
+        f.setAttribute(idx_fid, i)
 
     sink.addFeatures(features, QgsFeatureSink.FastInsert)
 
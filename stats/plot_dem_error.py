@@ -1,16 +1,25 @@
 import matplotlib.pyplot as plt
+import numpy as np
+from qgis.core import QgsFeatureRequest
 
 layer = iface.activeLayer()
+fields = layer.fields()
+names = ('Prominence', 'Crosscorrect prom', 'Detected prom', 'DEM prom')
+idx_prom, *idx_dems = [fields.lookupField(n) for n in names]
+for n, i in zip(names, [idx_prom] + idx_dems):
+    if i < 0:
+        raise KeyError(f"{layer.name()} has no {n} field")
 
-def dem_prom(f):
-    if f['Crosscorrect prom']:
-        return f['Crosscorrect prom']
-    if f['Detected prom']:
-        return f['Detected prom']
-    if f['DEM prom']:
-        return f['DEM prom']
+def dem_prom(attrs):
+    for i in idx_dems:
+        if attrs[i]:
+            return attrs[i]
     return -32767
-    
-prom, err = zip(*[(f['Prominence'], dem_prom(f) - f['Prominence']) for f in layer.getFeatures()])
+
+request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry)
+request.setSubsetOfAttributes([idx_prom] + idx_dems)
+attrs = [f.attributes() for f in layer.getFeatures(request)]
+prom = np.array([a[idx_prom] for a in attrs], dtype=float)
+err = np.array([dem_prom(a) for a in attrs], dtype=float) - prom
 plt.scatter(prom, err)
 plt.show()
\ No newline at end of file